@@ -1,8 +1,9 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 from pydantic import BaseModel
-from runner import run_and_upload, subscribers
-import asyncio
+from typing import Literal
+from runner import submit_render, start_render_loop, stop_render_loop, subscribers, SpscRing, SUBSCRIBER_QUEUE_SIZE
+import orjson
 import uvicorn
 import logging
 
@@ -16,46 +17,43 @@ class RunRequest(BaseModel):
     conversation_id: str
     code: str
     json_data: dict = {}
+    quality: Literal["l", "m", "h", "p", "k"] = "l"  # manim -q flag; l = 480p15
 
 @app.get("/render/logs/stream")
 async def sse(conversationId: str):
     """Server-Sent Events endpoint for streaming logs and closing connection after completion"""
     try:
         async def event_gen():
-            q = asyncio.Queue()
+            q = SpscRing(SUBSCRIBER_QUEUE_SIZE)
             subscribers[conversationId] = q
             try:
                 logger.info(f"Starting SSE stream for conversation: {conversationId}")
                 while True:
-                    try:
-                        # Wait for message with timeout to prevent hanging
-                        msg = await asyncio.wait_for(q.get(), timeout=30.0)
+                    msg = await q.get()
 
-                        # Send message
-                        yield f"data: {msg} \n\n"
+                    # Send message
+                    yield b"data: " + msg + b"\n\n"
 
-                        # Check for shutdown signal
-                        if msg.strip().lower() == "video generation completed!":
-                            logger.info(f"Received completion signal for {conversationId}, closing stream.")
-                            break  # Exit generator to close connection
-                        elif msg.lower().startswith("error:"):
-                            logger.info(f"Received error signal for {conversationId}, closing stream.")
-                            break
-                    except asyncio.TimeoutError:
-                        yield f'data: {{"data": "keepalive"}}\n\n'
+                    # Check for shutdown signal
+                    if msg.strip().lower() == b"video generation completed!":
+                        logger.info(f"Received completion signal for {conversationId}, closing stream.")
+                        break  # Exit generator to close connection
+                    elif msg.lower().startswith(b"error:"):
+                        logger.info(f"Received error signal for {conversationId}, closing stream.")
+                        break
             except Exception as e:
                 logger.error(f"Error in event generator: {e}")
-                yield f'data: {{"data": "Error: {str(e)}"}}\n\n'
+                yield b"data: " + orjson.dumps({"data": f"Error: {str(e)}"}) + b"\n\n"
             finally:
                 logger.info(f"Cleaning up SSE stream for conversation: {conversationId}")
                 subscribers.pop(conversationId, None)
 
-        return StreamingResponse(
-            event_gen(), 
-            media_type="text/event-stream",
+        # Pre-framed bytes pass straight through; idle connections get ping comments
+        return EventSourceResponse(
+            event_gen(),
+            ping=15,
             headers={
                 "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
                 "X-Accel-Buffering": "no"  # Disable nginx buffering
             }
         )
@@ -74,7 +72,7 @@ async def run(req: RunRequest):
         logger.info(f"Starting video generation for conversation: {req.conversation_id}")
         
         # Run the video generation and wait for completion
-        url = await run_and_upload(req.conversation_id, req.code, req.json_data)
+        url = await submit_render(req.conversation_id, req.code, req.json_data, req.quality)
         
         return {
             "status": "success", 
@@ -96,13 +94,15 @@ async def health_check():
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting Manim Video Generator API")
+    start_render_loop()
 
 @app.on_event("shutdown") 
 async def shutdown_event():
     logger.info("Shutting down Manim Video Generator API")
     # Clean up any remaining subscribers
     subscribers.clear()
+    await stop_render_loop()
 
 if __name__ == "__main__":
     print("Starting server...")
-    uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=False)
\ No newline at end of file
+    uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=False, loop="uvloop")
\ No newline at end of file
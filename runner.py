@@ -1,13 +1,20 @@
 import os
 import subprocess
 import tempfile
-import requests
+import shutil
+import httpx
+import aiofiles
+import orjson
 import asyncio
+import threading
+import contextlib
 import logging
 from pathlib import Path
 from typing import Optional
 from dotenv import load_dotenv
 import re
+import glob
+import uvloop
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,73 +31,363 @@ SPRING_CALLBACK_URL = os.getenv("SPRING_CALLBACK_URL")
 if not all([SUPABASE_URL, SUPABASE_API_KEY, SUPABASE_BUCKET]):
     raise ValueError("Missing required environment variables: SUPABASE_URL, SUPABASE_API_KEY, SUPABASE_BUCKET")
 
-subscribers = {}  # conversationId -> asyncio.Queue()
+SUBSCRIBER_QUEUE_SIZE = 256
+OUTPUT_PIPE_SIZE = 64
+PROGRESS_FLUSH_INTERVAL = 0.1  # seconds
+WORK_POOL_SIZE = int(os.getenv("WORK_POOL_SIZE", "4"))
 
-def extract_log(line: str) -> Optional[str]:
-    """Extract meaningful log messages from manim output"""
+# Manim quality flag -> output subdirectory under media/videos/<scene file>/
+QUALITY_DIRS = {"l": "480p15", "m": "720p30", "h": "1080p60", "p": "1440p60", "k": "2160p60"}
+DEFAULT_QUALITY = "l"  # 480p15; callers can opt into higher resolutions
+subscribers = {}  # conversationId -> SpscRing(SUBSCRIBER_QUEUE_SIZE) of encoded messages
+
+# Shared HTTP client so uploads and callbacks reuse pooled connections
+client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    timeout=60
+)
+
+# Pre-created working directories reused across renders; also caps concurrent renders
+work_pool = asyncio.Queue()
+_work_dirs = []  # every pool directory, so shutdown can remove them
+_recycling = set()
+
+def _reset_work_dir(work_dir: str) -> None:
+    """Wipe a working directory and recreate its media layout"""
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(os.path.join(work_dir, "media", "videos"), exist_ok=True)
+
+def init_work_pool() -> None:
+    """Seed the pool with WORK_POOL_SIZE ready-to-use working directories"""
+    for i in range(WORK_POOL_SIZE):
+        work_dir = tempfile.mkdtemp(prefix=f"manim-w{i}-")
+        _work_dirs.append(work_dir)
+        _reset_work_dir(work_dir)
+        work_pool.put_nowait(work_dir)
+
+def remove_work_pool() -> None:
+    """Delete all pool directories"""
+    for work_dir in _work_dirs:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    _work_dirs.clear()
+
+async def _recycle_work_dir(work_dir: str) -> None:
+    """Clean a used working directory off the event loop and return it to the pool"""
     try:
-        if "Animation" in line and "Partial" in line:
-            m = re.search(r"Animation (\d+)", line)
-            if m: 
-                return f"Animation {m.group(1)} loaded"
-        elif re.match(r".*Animation (\d+):.*?(\d+)%\|.*", line):
-            m = re.search(r"Animation (\d+):.*?(\d+)%\|", line)
-            if m: 
-                return f"Animation {m.group(1)} progress: {m.group(2)}%"
-        elif "File ready at" in line:
-            return "Final video ready!"
-        elif "Rendered ArchitectureDiagram" in line:
+        await asyncio.to_thread(_reset_work_dir, work_dir)
+    except Exception as e:
+        # Still hand it back: losing pool slots would eventually block every render
+        logger.error(f"Failed to reset work dir {work_dir}: {e}")
+    finally:
+        work_pool.put_nowait(work_dir)
+
+# Renders run on their own event loop thread so manim output handling never
+# competes with the API loop serving SSE streams
+render_loop: Optional[asyncio.AbstractEventLoop] = None
+api_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def start_render_loop() -> None:
+    """Seed the work pool and start the render worker thread; call from the API event loop"""
+    global render_loop, api_loop
+    init_work_pool()
+    api_loop = asyncio.get_running_loop()
+    render_loop = uvloop.new_event_loop()
+    threading.Thread(target=render_loop.run_forever, name="render-loop", daemon=True).start()
+    logger.info("Render worker loop started")
+
+async def stop_render_loop() -> None:
+    """Close the shared HTTP client on the render loop, stop the render thread and remove the work pool"""
+    global render_loop
+    if render_loop is not None:
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), render_loop))
+        render_loop.call_soon_threadsafe(render_loop.stop)
+        render_loop = None
+    else:
+        await client.aclose()
+    await asyncio.to_thread(remove_work_pool)
+
+async def submit_render(conversation_id: str, code: str, json_data: dict, quality: str = DEFAULT_QUALITY) -> str:
+    """Run run_and_upload on the render loop and await its result from the caller's loop"""
+    if render_loop is None:
+        raise RuntimeError("Render loop is not running")
+    future = asyncio.run_coroutine_threadsafe(
+        run_and_upload(conversation_id, code, json_data, quality), render_loop
+    )
+    return await asyncio.wrap_future(future)
+
+class SpscRing:
+    """Single-producer/single-consumer ring buffer for one SSE stream.
+
+    Both ends must run on the same event loop. When full, put overwrites the
+    oldest entry so the stream always carries the latest state.
+    """
+    __slots__ = ("buf", "mask", "head", "tail", "event")
+
+    def __init__(self, capacity: int = SUBSCRIBER_QUEUE_SIZE):
+        size = 1 << (capacity - 1).bit_length()  # round up to a power of two
+        self.buf = [None] * size
+        self.mask = size - 1
+        self.head = 0
+        self.tail = 0
+        self.event = asyncio.Event()
+
+    def put(self, item) -> None:
+        self.buf[self.tail & self.mask] = item
+        self.tail += 1
+        if self.tail - self.head > self.mask:
+            self.head = self.tail - self.mask - 1
+        self.event.set()
+
+    async def get(self):
+        while self.head == self.tail:
+            self.event.clear()
+            await self.event.wait()
+        i = self.head & self.mask
+        item = self.buf[i]
+        self.buf[i] = None
+        self.head += 1
+        return item
+
+def _deliver(conversation_id: str, msg: bytes) -> None:
+    """Push a message to the current subscriber, if any"""
+    q = subscribers.get(conversation_id)
+    if q is not None:
+        q.put(msg)
+
+def publish(conversation_id: str, msg: str) -> None:
+    """Send a message to the subscriber; queues live on the API loop, so hop there"""
+    msg = msg.encode()
+    if api_loop is not None:
+        api_loop.call_soon_threadsafe(_deliver, conversation_id, msg)
+    else:
+        _deliver(conversation_id, msg)
+
+READY_MESSAGE = "Final video ready!"
+
+# One pass over each line; dispatch on whichever alternative matched first
+LOG_PATTERN = re.compile(
+    rb"(?P<partial>Animation (?P<pnum>\d+).*Partial)"
+    rb"|(?P<progress>Animation (?P<gnum>\d+):.*?(?P<pct>\d+)%\|)"
+    rb"|(?P<ready>File ready at)"
+    rb"|(?P<done>Rendered ArchitectureDiagram)"
+    rb"|(?P<played>Played)"
+    rb"|(?P<error>ERROR|Exception)"
+)
+
+def extract_log(line: bytes) -> Optional[str]:
+    """Extract meaningful log messages from raw manim output; only matches are decoded"""
+    try:
+        m = LOG_PATTERN.search(line)
+        if not m:
+            return None
+        kind = m.lastgroup
+        if kind == "partial":
+            return f"Animation {m.group('pnum').decode()} loaded"
+        elif kind == "progress":
+            return f"Animation {m.group('gnum').decode()} progress: {m.group('pct').decode()}%"
+        elif kind == "ready":
+            return READY_MESSAGE
+        elif kind == "done":
             return "Rendering complete!"
-        elif "Played" in line:
-            return line.strip()
-        elif "ERROR" in line or "Exception" in line:
-            return "Error occurred"
-        return None
+        elif kind == "played":
+            return line.strip().decode('utf-8', 'replace')
+        return "Error occurred"
     except Exception as e:
         logger.error(f"Error extracting log: {e}")
         return None
 
-def upload_to_supabase(file_path: str, filename: str) -> str:
+async def iter_lines(stream: asyncio.StreamReader, size: int = 8192):
+    """Read the stream in large chunks and yield complete lines, keeping partial tails"""
+    pending = b""
+    while True:
+        chunk = await stream.read(size)
+        if not chunk:
+            break
+        lines = (pending + chunk).splitlines()
+        # Hold back the last piece unless the chunk ended on a line break
+        pending = lines.pop() if chunk[-1:] not in (b"\n", b"\r") else b""
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+async def read_output(stream: asyncio.StreamReader, pipe: asyncio.Queue) -> None:
+    """Drain subprocess output into the pipeline queue, then signal end with None"""
+    async for line in iter_lines(stream):
+        await pipe.put(line)
+    await pipe.put(None)
+
+async def broadcast_output(conversation_id: str, pipe: asyncio.Queue, video_ready: asyncio.Event) -> None:
+    """Turn raw manim output lines from the pipeline into subscriber updates.
+
+    Progress updates are coalesced per animation and flushed every
+    PROGRESS_FLUSH_INTERVAL seconds; any other message flushes pending
+    progress first so ordering is preserved. video_ready is set once manim
+    reports the final file, whether or not anyone is subscribed.
+    """
+    pending = {}  # "Animation N" -> latest progress message
+
+    def flush() -> None:
+        for msg in pending.values():
+            publish(conversation_id, msg)
+        pending.clear()
+
+    async def flush_loop() -> None:
+        while True:
+            await asyncio.sleep(PROGRESS_FLUSH_INTERVAL)
+            flush()
+
+    flusher = asyncio.create_task(flush_loop())
+    try:
+        while (line := await pipe.get()) is not None:
+            line = line.strip()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Manim: %s", line.decode('utf-8', 'replace'))
+            
+            if conversation_id not in subscribers:
+                # Nobody is listening; only watch for the finished file
+                if line.find(b"File ready at") != -1:
+                    video_ready.set()
+                continue
+            
+            # Extract and send meaningful updates
+            log_message = extract_log(line)
+            if not log_message:
+                continue
+            if log_message == READY_MESSAGE:
+                video_ready.set()
+            key, sep, _ = log_message.partition(" progress: ")
+            if sep:
+                pending[key] = log_message
+            else:
+                flush()
+                publish(conversation_id, log_message)
+    finally:
+        flusher.cancel()
+        flush()
+
+async def drain_output(process: asyncio.subprocess.Process, conversation_id: str, video_ready: asyncio.Event) -> int:
+    """Run the output pipeline alongside process.wait() and return manim's exit code.
+
+    If any stage fails or the caller is cancelled, the other stages are
+    cancelled and manim is killed so nothing stays blocked on a full pipe.
+    """
+    pipe = asyncio.Queue(maxsize=OUTPUT_PIPE_SIZE)
+    tasks = [
+        asyncio.create_task(read_output(process.stdout, pipe)),
+        asyncio.create_task(broadcast_output(conversation_id, pipe, video_ready)),
+        asyncio.create_task(process.wait())
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        if process.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await process.wait()
+        raise
+    return tasks[2].result()
+
+async def upload_video(conversation_id: str, video_path: str) -> str:
+    """Announce and upload a rendered video, returning its public URL"""
+    logger.info(f"Found video file: {video_path}")
+    publish(conversation_id, "Uploading video...")
+    return await upload_to_supabase(video_path, f"{conversation_id}.mp4")
+
+async def upload_when_ready(conversation_id: str, video_path: str, video_ready: asyncio.Event) -> Optional[str]:
+    """Upload the video as soon as manim reports it written; None if it isn't at video_path"""
+    await video_ready.wait()
+    if not os.path.exists(video_path):
+        return None
+    return await upload_video(conversation_id, video_path)
+
+async def discard_upload(upload_task: asyncio.Task, filename: str) -> None:
+    """Cancel a speculative upload that is no longer wanted and reap it.
+
+    If it had already completed, the object is deleted so storage doesn't keep
+    a video for a render that is reported as failed.
+    """
+    upload_task.cancel()
+    video_url = None
+    with contextlib.suppress(BaseException):
+        video_url = await upload_task
+    if video_url is not None:
+        await delete_from_supabase(filename)
+
+async def file_chunks(file_path: str, size: int = 1 << 20):
+    """Yield the file contents in chunks without blocking the event loop.
+
+    A single buffer is reused for every read, so each chunk is only valid until
+    the next one is requested; the HTTP client writes it out before then.
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    async with aiofiles.open(file_path, 'rb') as f:
+        while n := await f.readinto(buf):
+            yield view[:n]
+
+async def upload_to_supabase(file_path: str, filename: str) -> str:
     """Upload file to Supabase storage"""
     try:
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File not found: {file_path}")
             
-        with open(file_path, 'rb') as f:
-            headers = {
-                "apikey": SUPABASE_API_KEY,
-                "Authorization": f"Bearer {SUPABASE_API_KEY}",
-                "Content-Type": "application/octet-stream",
-                "x-upsert": "true"
-            }
-            upload_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{filename}"
-            
-            logger.info(f"Uploading {filename} to Supabase...")
-            response = requests.post(upload_url, data=f, headers=headers, timeout=60)
-            response.raise_for_status()
-            
-            public_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{filename}"
-            logger.info(f"Upload successful: {public_url}")
-            return public_url
+        headers = {
+            "apikey": SUPABASE_API_KEY,
+            "Authorization": f"Bearer {SUPABASE_API_KEY}",
+            "Content-Type": "application/octet-stream",
+            # Known length lets the body stream without chunked transfer encoding
+            "Content-Length": str(os.path.getsize(file_path)),
+            "x-upsert": "true"
+        }
+        upload_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{filename}"
+        
+        logger.info(f"Uploading {filename} to Supabase...")
+        response = await client.post(upload_url, content=file_chunks(file_path), headers=headers)
+        response.raise_for_status()
+        
+        public_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{filename}"
+        logger.info(f"Upload successful: {public_url}")
+        return public_url
             
     except Exception as e:
         logger.error(f"Failed to upload to Supabase: {e}")
         raise
 
-async def run_and_upload(conversation_id: str, code: str, json_data: dict) -> str:
+async def delete_from_supabase(filename: str) -> None:
+    """Delete a file from Supabase storage; failures are logged, not raised"""
+    try:
+        headers = {
+            "apikey": SUPABASE_API_KEY,
+            "Authorization": f"Bearer {SUPABASE_API_KEY}"
+        }
+        delete_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{filename}"
+        
+        logger.info(f"Deleting {filename} from Supabase...")
+        response = await client.delete(delete_url, headers=headers)
+        response.raise_for_status()
+        
+    except Exception as e:
+        logger.error(f"Failed to delete from Supabase: {e}")
+
+async def run_and_upload(conversation_id: str, code: str, json_data: dict, quality: str = DEFAULT_QUALITY) -> str:
     """Run manim animation and upload the result"""
     try:
         logger.info(f"Starting video generation for conversation: {conversation_id}")
         
-        with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = await work_pool.get()
+        try:
             # Create Python file
             py_path = os.path.join(tmp_dir, f"{conversation_id}.py")
             with open(py_path, "w", encoding="utf-8") as f:
                 f.write(code)
             
-            # Create media directory
+            # Media directory is pre-created by the work pool
             media_dir = os.path.join(tmp_dir, "media")
-            os.makedirs(media_dir, exist_ok=True)
             
             # Prepare manim command
             cmd = [
@@ -100,14 +397,14 @@ async def run_and_upload(conversation_id: str, code: str, json_data: dict) -> st
                 "--format", "mp4", 
                 "-o", f"{conversation_id}.mp4",
                 "--media_dir", media_dir,
+                "-q", quality,
                 "-v", "INFO"  # Set verbosity level
             ]
             
             logger.info(f"Running command: {' '.join(cmd)}")
             
             # Send initial status
-            if conversation_id in subscribers:
-                await subscribers[conversation_id].put("Starting video generation...")
+            publish(conversation_id, "Starting video generation...")
             
             # Run manim process
             process = await asyncio.create_subprocess_exec(
@@ -117,85 +414,68 @@ async def run_and_upload(conversation_id: str, code: str, json_data: dict) -> st
                 cwd=tmp_dir
             )
             
-            # Process output line by line
-            while True:
-                line = await process.stdout.readline()
-                if not line:
-                    break
-                    
-                line = line.decode('utf-8').strip()
-                logger.info(f"Manim: {line}")
-                
-                # Extract and send meaningful updates
-                log_message = extract_log(line)
-                if log_message and conversation_id in subscribers:
-                    try:
-                        await subscribers[conversation_id].put(log_message)
-                    except Exception as e:
-                        logger.error(f"Failed to send update to subscriber: {e}")
-            
-            # Wait for process to complete
-            return_code = await process.wait()
+            # Manim's output path is fully determined by the file name, quality and -o
+            video_path = os.path.join(
+                media_dir, "videos", Path(py_path).stem,
+                QUALITY_DIRS[quality], f"{conversation_id}.mp4"
+            )
+            
+            # Start uploading as soon as manim reports the file, overlapping
+            # the transfer with manim's own shutdown
+            video_ready = asyncio.Event()
+            upload_task = asyncio.create_task(upload_when_ready(conversation_id, video_path, video_ready))
+            
+            # Drain output and deliver updates concurrently so a slow consumer
+            # never stalls the manim pipe
+            try:
+                return_code = await drain_output(process, conversation_id, video_ready)
+            except BaseException:
+                await discard_upload(upload_task, f"{conversation_id}.mp4")
+                raise
             if return_code != 0:
+                await discard_upload(upload_task, f"{conversation_id}.mp4")
                 error_msg = f"Manim process failed with return code {return_code}"
                 logger.error(error_msg)
                 raise subprocess.CalledProcessError(return_code, cmd)
             
-            # Find the generated video file
-            video_files = []
-            for root, dirs, files in os.walk(media_dir):
-                for file in files:
-                    if file.endswith('.mp4'):
-                        video_files.append(os.path.join(root, file))
-            
-            if not video_files:
-                # Try alternative locations
-                alt_locations = [
-                    os.path.join(tmp_dir, f"{conversation_id}.mp4"),
-                    os.path.join(tmp_dir, "media", "videos", f"{conversation_id}.mp4"),
-                    os.path.join(tmp_dir, "media", "videos", "480p15", f"{conversation_id}.mp4"),
-                    os.path.join(tmp_dir, "media", "videos", "720p30", f"{conversation_id}.mp4"),
-                    os.path.join(tmp_dir, "media", "videos", "1080p60", f"{conversation_id}.mp4")
-                ]
-                
-                for location in alt_locations:
-                    if os.path.exists(location):
-                        video_files.append(location)
-                        break
-            
-            if not video_files:
-                error_msg = "No video file was generated"
-                logger.error(error_msg)
-                logger.error(f"Files in tmp_dir: {os.listdir(tmp_dir)}")
-                if os.path.exists(media_dir):
-                    logger.error(f"Files in media_dir: {os.listdir(media_dir)}")
-                raise FileNotFoundError(error_msg)
-            
-            # Use the first video file found
-            video_path = video_files[0]
-            logger.info(f"Found video file: {video_path}")
+            if video_ready.is_set():
+                video_url = await upload_task
+            else:
+                await discard_upload(upload_task, f"{conversation_id}.mp4")
+                video_url = None
             
-            # Send upload status
-            if conversation_id in subscribers:
-                await subscribers[conversation_id].put("Uploading video...")
-            
-            # Upload to Supabase
-            video_url = upload_to_supabase(video_path, f"{conversation_id}.mp4")
+            if video_url is None:
+                # Manim never reported the file, or wrote it somewhere unexpected
+                if not os.path.exists(video_path):
+                    video_files = glob.glob(
+                        os.path.join(media_dir, "videos", "**", f"{conversation_id}.mp4"),
+                        recursive=True
+                    )
+                    if not video_files:
+                        error_msg = "No video file was generated"
+                        logger.error(error_msg)
+                        logger.error(f"Files in tmp_dir: {os.listdir(tmp_dir)}")
+                        if os.path.exists(media_dir):
+                            logger.error(f"Files in media_dir: {os.listdir(media_dir)}")
+                        raise FileNotFoundError(error_msg)
+                    video_path = video_files[0]
+                
+                video_url = await upload_video(conversation_id, video_path)
             
             # Send completion status
-            if conversation_id in subscribers:
-                await subscribers[conversation_id].put("Video generation completed!")
+            publish(conversation_id, "Video generation completed!")
             
             # Notify Spring backend if configured
             if SPRING_CALLBACK_URL:
                 try:
                     logger.info("Notifying Spring backend...")
-                    callback_response = requests.post(
+                    callback_response = await client.post(
                         SPRING_CALLBACK_URL, 
-                        json={
+                        content=orjson.dumps({
                             "conversationId": conversation_id,
                             "videoUrl": video_url
-                        },
+                        }),
+                        headers={"Content-Type": "application/json"},
                         timeout=30
                     )
                     callback_response.raise_for_status()
@@ -205,15 +485,16 @@ async def run_and_upload(conversation_id: str, code: str, json_data: dict) -> st
                     # Don't fail the entire process if callback fails
             
             return video_url
+        finally:
+            # Clean up in the background so the response isn't held by rmtree
+            task = asyncio.create_task(_recycle_work_dir(tmp_dir))
+            _recycling.add(task)
+            task.add_done_callback(_recycling.discard)
             
     except Exception as e:
         logger.error(f"Error in run_and_upload: {e}")
         
         # Send error to subscribers
-        if conversation_id in subscribers:
-            try:
-                await subscribers[conversation_id].put(f"Error: {str(e)}")
-            except:
-                pass
+        publish(conversation_id, f"Error: {str(e)}")
         
         raise
\ No newline at end of file